@@ -1,10 +1,14 @@
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import os
+import re
+import threading
 import time
 import logging
 
 try:
     from watchdog.observers import Observer
+    from watchdog.observers.polling import PollingObserver
     from watchdog.events import FileSystemEventHandler
     _has_watchdog = True
 except ImportError:
@@ -12,6 +16,22 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# Changes with a lower number are synced first. See `Synchronizer._push_change`.
+ACTION_PRIORITY = {"deleted": 0, "updated": 1, "created": 2}
+
+# In `Synchronizer.watch()`, sync once no changes have been seen for
+# WATCH_SETTLE_TIME seconds, or WATCH_MAX_SETTLE_TIME seconds after the first
+# change, whichever comes first.
+WATCH_SETTLE_TIME = 0.1
+WATCH_MAX_SETTLE_TIME = 5
+
+# Filesystem types which `Synchronizer.watch()` polls every POLLING_INTERVAL
+# seconds instead of relying on filesystem events.
+NETWORK_FILESYSTEMS = {
+    "nfs", "nfs4", "cifs", "smbfs", "smb3", "9p", "fuse.sshfs",
+}
+POLLING_INTERVAL = 60
+
 
 class Synchronizer:
     """
@@ -26,19 +46,54 @@ class Synchronizer:
         #    * Overlap in any way
         # This could cause an update infinite loop (which we have checks to
         # make not infinite, but still...)
-        for root1 in self.roots:
-            for root2 in self.roots:
-                if root1 is root2: continue
-                common = os.path.commonpath((root1.root_path, root2.root_path))
-                if common.endswith(root1.root_path) or \
-                        common.endswith(root2.root_path):
-                    raise ValueError(
-                        'One root cannot be inside another. Offending paths:\n'
-                        f'{root1.root_path}\n{root2.root_path}'
-                    )
-
-        for root in self.roots:
+        #
+        # Paths are compared as tuples of components, split once up front.
+        # Sorting them puts every directory directly before the paths inside
+        # of it, so only adjacent pairs need to be compared, and a root is
+        # inside another (or the same) if the other's components are a prefix
+        # of its own.
+        norm = sorted(
+            ((tuple(os.path.realpath(root.root_path).rstrip(os.sep)
+                    .split(os.sep)), root)
+             for root in self.roots),
+            key=lambda item: item[0]
+        )
+        for (prev_path, prev_root), (cur_path, cur_root) in zip(norm, norm[1:]):
+            if cur_path[:len(prev_path)] == prev_path:
+                raise ValueError(
+                    'One root cannot be inside another. Offending paths:\n'
+                    f'{prev_root.root_path}\n{cur_root.root_path}'
+                )
+
+        # Guards `_change_queues`, which roots push to from executor threads.
+        self._change_lock = threading.Lock()
+
+        def inspect(root):
             root.inspect_root_for_changes(force_hash=force_hash)
+        with self._new_executor():
+            self._in_parallel(inspect, self.roots)
+
+    def _new_executor(self):
+        """
+        Create the executor used by `_in_parallel()`. Use it as a context
+        manager, so its threads are shut down once the work is done.
+        """
+        # Work on the roots is mostly waiting on the filesystem, and roots are
+        # often on different devices, so it's done in parallel when possible.
+        self._executor = ThreadPoolExecutor(max_workers=max(1, len(self.roots)))
+        return self._executor
+
+    def _in_parallel(self, func, items):
+        """
+        Call `func(item)` for every item, in parallel threads. Each item should
+        only touch one root. Must be called inside `with self._new_executor()`.
+        """
+        if len(items) <= 1:
+            for item in items:
+                func(item)
+            return
+        # Consume the results so exceptions are raised here
+        list(self._executor.map(func, items))
 
     def sync(self, trust_previous_sync=False):
         """Sync all roots with eachother.
@@ -46,30 +101,47 @@ class Synchronizer:
         If `trust_previous_sync` is True, trust that the previous sync was
         performed on the same root directories that we are dealing with now.
         """
+        with self._new_executor():
+            self._sync(trust_previous_sync)
+
+    def _sync(self, trust_previous_sync):
+        # Queue up all changes, and any new changes detected while syncing.
+        # One {depth: deque of (path, root, action)} per action priority.
+        self._change_queues = [defaultdict(deque) for _ in ACTION_PRIORITY]
+        for root in self.roots:
+            for path, (action, stat) in root.changes.items():
+                self._push_change(root, path, action)
+            root.change_callback = self._push_change
+
         path_seen_counter = defaultdict(lambda: 0)
-        while True:
-            path = self._get_changed_path()
-            if path is None:
-                break
-            path_seen_counter[path] += 1
-
-            # Ignore path if we've seen it too many times.
-            # This check does two things: 1) prevents infinite loops due to a
-            # bug, and 2) handles a very rare case where we never return
-            # because the user keeps writing to this file while we're syncing
-            # it.
-            if path_seen_counter[path] > 10:
-                logger.warning(f"Path encountered more than 10 times: {path}")
-                break
-
-            self._sync_path(path)
+        try:
+            while True:
+                path = self._get_changed_path()
+                if path is None:
+                    break
+                path_seen_counter[path] += 1
+
+                # Ignore path if we've seen it too many times.
+                # This check does two things: 1) prevents infinite loops due
+                # to a bug, and 2) handles a very rare case where we never
+                # return because the user keeps writing to this file while
+                # we're syncing it.
+                if path_seen_counter[path] > 10:
+                    logger.warning(f"Path encountered more than 10 times: {path}")
+                    break
+
+                self._sync_path(path)
+        finally:
+            for root in self.roots:
+                root.change_callback = None
 
         # If the previous sync call didn't include the same roots that we're
         # dealing with now, any roots left out of the last sync wouldn't have
         # gotten the changes from that sync. This handles that case by checking
         # the metadata between all roots for paths that weren't just updated to
-        # make sure they match.
-        if not trust_previous_sync:
+        # make sure they match. That can be skipped if all of the roots'
+        # states already agree.
+        if not trust_previous_sync and not self._states_agree():
             for root in self.roots:
                 for path in root.state.paths():
                     if path in path_seen_counter:
@@ -82,8 +154,11 @@ class Synchronizer:
                     self._sync_path(path)
 
         # Write state to all roots
-        for root in self.roots:
-            root.write_state()
+        self._in_parallel(lambda root: root.write_state(), self.roots)
+
+    def _states_agree(self):
+        """Return True if all roots have the same metadata for every path."""
+        return len({root.state.manifest_hash() for root in self.roots}) <= 1
 
     def _sync_path(self, path):
         """
@@ -92,89 +167,106 @@ class Synchronizer:
 
         This expects at least one root to have detected a change.
         """
-
-        # Detect types of changes
-        was_deleted = False
-        was_updated_or_created = False
+        # Look up everything we need to know about the path in each root once.
+        # [(root, action, change_stat, state_stat, state_hash), ...]
+        infos = []
         for root in self.roots:
-            action, stat = root.changes.get(path, (None, None))
-            if action == "deleted":
-                was_deleted = True
-            if action in ("updated", "created"):
-                was_updated_or_created = True
+            action, change_stat = root.changes.get(path, (None, None))
+            infos.append((
+                root,
+                action,
+                change_stat,
+                root.state.path_get_stat(path),
+                root.state.path_get_hash(path),
+            ))
 
-            if was_deleted and was_updated_or_created:
-                break
+        # Detect types of changes
+        actions = {info[1] for info in infos}
+        was_deleted = "deleted" in actions
+        was_updated_or_created = "updated" in actions or "created" in actions
 
         # If no explicit changes were detected, check metadata and consider it
         # an update if they don't all agree.
         if not was_deleted and not was_updated_or_created:
-            types = set()
-            hashes = set()
-            for root in self.roots:
-                stat = root.state.path_get_stat(path)
-                if stat:
-                    types.add(stat.type)
-                else:
-                    types.add("deleted")
-                hashes.add(root.state.path_get_hash(path))
+            types = {
+                state_stat.type if state_stat else "deleted"
+                for _, _, _, state_stat, _ in infos
+            }
+            hashes = {state_hash for _, _, _, _, state_hash in infos}
             if len(types) > 1 or len(hashes) > 1:
                 was_updated_or_created = True
 
         # If at least one root has deleted, delete for everybody.
         if was_deleted:
-            for root in self.roots:
-                action, stat = root.changes.get(path, (None, None))
+            def delete(info):
+                root, action, _, _, _ = info
                 if action != "deleted":
                     root.perform_delete(path)
                 else:
                     root.remove_change(path)
+            self._in_parallel(delete, infos)
 
         # Somebody updated. Update the roots with older copies
         elif was_updated_or_created:
-            source_root = self._get_root_with_golden_copy(path)
-            self._update_roots(source_root, path)
+            source_info = self._get_golden_copy_info(infos)
+            self._update_roots(infos, source_info, path)
 
-    def _update_roots(self, source_root, path):
-        """Update all roots to `source_root`'s copy of path."""
-        for root in self.roots:
-            if root is not source_root:
-
-                # Only perform change if mode or stat actually changed
-                old_hash = root.state.path_get_hash(path)
-                old_stat = root.state.path_get_stat(path)
-                new_hash = source_root.state.path_get_hash(path)
-                new_stat = source_root.state.path_get_stat(path)
-                if old_hash == new_hash and \
-                        old_stat and new_stat and \
-                        old_stat.st_mode == new_stat.st_mode:
-                    root.remove_change(path)
-                else:
-                    root.perform_update(path, source_root.abspath(path))
+    def _update_roots(self, infos, source_info, path):
+        """
+        Update all roots to the copy of path in the root of `source_info`.
+
+        `infos` and `source_info` are as built by `_sync_path()`.
+        """
+        source_root, _, _, new_stat, new_hash = source_info
+        source_abspath = source_root.abspath(path)
+
+        # Only perform change if mode or stat actually changed
+        def needs_update(info):
+            root, _, _, old_stat, old_hash = info
+            if root is source_root:
+                return False
+            return old_hash != new_hash or \
+                not old_stat or not new_stat or \
+                old_stat.st_mode != new_stat.st_mode
+
+        # Open a regular file once for all of the roots copying it.
+        source_fd = None
+        if new_stat and new_stat.is_regular and any(map(needs_update, infos)):
+            source_fd = os.open(source_abspath, os.O_RDONLY)
+
+        def update(info):
+            root = info[0]
+            if needs_update(info):
+                root.perform_update(path, source_abspath,
+                                    source_hash=new_hash, source_fd=source_fd)
             else:
                 root.remove_change(path)
 
-    def _get_root_with_golden_copy(self, path):
+        try:
+            self._in_parallel(update, infos)
+        finally:
+            if source_fd is not None:
+                os.close(source_fd)
+
+    def _get_golden_copy_info(self, infos):
         """
-        Looks at `path` in all roots and returns the root that has the best
-        (usually most up to date) copy.
+        Looks at a path's `infos` from `_sync_path()` and returns the info of
+        the root that has the best (usually most up to date) copy.
         """
         # Find the root with the latest updated time of path.
-        root_stats = []  # [(root, was_changed, stat), ...]
-        for root in self.roots:
+        root_stats = []  # [(info, was_changed, stat), ...]
+        for info in infos:
+            _, _, change_stat, state_stat, _ = info
 
-            # Get root from root.changes or root.state, or None.
-            was_changed = True
-            stat = root.changes.get(path, (None, None))[1]
-            if stat is None:
-                was_changed = False
-                stat = root.state.path_get_stat(path)
+            # Get stat from the change or the state, or None.
+            was_changed = change_stat is not None
+            stat = change_stat if was_changed else state_stat
 
             if stat:
-                root_stats.append((root, was_changed, stat))
+                root_stats.append((info, was_changed, stat))
 
         def sort_key(root_stat):
-            root, was_changed, stat = root_stat
+            info, was_changed, stat = root_stat
             return (
                 # Prioritize actual changes seen over old info
                 0 if was_changed else 1,
@@ -185,18 +277,11 @@ class Synchronizer:
             )
 
         root_stats.sort(key=sort_key)
-        golden_root, _, _ = root_stats[0]
-        return golden_root
-
-    def _get_changed_path(self):
-        """Get a path that has changed in one of the roots."""
-        #TODO: Optimize this so we don't have to iterate over changes
-        #      n_changes**2 times.
-        changes = []
-        for root in self.roots:
-            for path, (action, stat) in root.changes.items():
-                changes.append((path, action, stat))
+        golden_info, _, _ = root_stats[0]
+        return golden_info
 
+    def _push_change(self, root, path, action):
+        """Queue a change for `_get_changed_path()` to return."""
         # Sort order
         # From most to least significant, here are the factors that decide
         # which change is returned:
@@ -206,7 +291,7 @@ class Synchronizer:
         #   TODO: Honestly not sure if this is needed. Removing it doesn't fail
         #     any tests.
         #
-        # Longest path first:
+        # Deepest path first:
         #   For deletes, this insures that files inside directories are deleted before the
         #   directory itself.
         #
@@ -216,20 +301,38 @@ class Synchronizer:
         #   updates "foo/bar". The "foo/bar" update will be performed first,
         #   and the process of root1 updating "foo/bar" it will remove the
         #   pending change to "foo".
-        def sort_key(change):
-            path, action, stat = change
-            action_priority = ["deleted", "updated", "created"]
-            return (
-                action_priority.index(action),
-                -len(path),
-            )
+        #
+        # Changes are bucketed by priority and depth rather than sorted, so
+        # queueing and taking one doesn't slow down as the queue grows.
+        depth = path.count(os.sep)
+        with self._change_lock:
+            queue = self._change_queues[ACTION_PRIORITY[action]][depth]
+            queue.append((path, root, action))
+
+    def _pop_change(self):
+        """Take the next queued change, or return None if there are none."""
+        with self._change_lock:
+            for buckets in self._change_queues:
+                while buckets:
+                    depth = max(buckets)
+                    if buckets[depth]:
+                        return buckets[depth].popleft()
+                    del buckets[depth]
+        return None
 
-        if changes:
-            changes.sort(key=sort_key)
-            path, action, stat = changes[0]
-            return path
-        else:
-            return None
+    def _get_changed_path(self):
+        """Get a path that has changed in one of the roots."""
+        while True:
+            change = self._pop_change()
+            if change is None:
+                return None
+            path, root, action = change
+
+            # The change may have been resolved or replaced since it was
+            # queued. A replacement is queued separately.
+            current_action, _ = root.changes.get(path, (None, None))
+            if current_action == action:
+                return path
 
     def watch(self):
         # Watch all roots and call self._sync_path(path) for any path changed.
@@ -241,40 +344,111 @@ class Synchronizer:
 
         self.sync()
 
+        # Set by the observer threads whenever a path changes
+        wakeup = threading.Event()
+
         class SyncRootEventHandler(FileSystemEventHandler):
             def __init__(self, root):
                 self.root = root
                 self.updated_paths = set()
+                # Guards `updated_paths`, which is added to from the observer
+                # thread.
+                self.lock = threading.Lock()
 
             def on_any_event(self, event):
                 self.add_path(event.src_path)
-                if hasattr(event, "dest_path"):
+                if getattr(event, "dest_path", None):
                     self.add_path(event.dest_path)
 
             def add_path(self, path):
                 path = os.path.normpath(os.path.abspath(path))
                 path = os.path.relpath(path, self.root.root_path)
-                self.updated_paths.add(path)
-
+                with self.lock:
+                    self.updated_paths.add(path)
+                # Our own writes to the state directory don't need a sync
+                if not self.root.should_ignore_path(path):
+                    wakeup.set()
+
+        # Native observers (inotify, etc.) don't see changes made on another
+        # machine to a network filesystem, so those roots have to be polled.
         observer = Observer()
+        polling_observer = None
         event_handlers = []
         for root in self.roots:
             event_handler = SyncRootEventHandler(root)
             event_handlers.append(event_handler)
-            observer.schedule(
+            if get_filesystem_type(root.root_path) in NETWORK_FILESYSTEMS:
+                if polling_observer is None:
+                    polling_observer = PollingObserver(timeout=POLLING_INTERVAL)
+                root_observer = polling_observer
+            else:
+                root_observer = observer
+            root_observer.schedule(
                 event_handler,
                 root.root_path,
                 recursive=True
             )
         observer.start()
+        if polling_observer is not None:
+            polling_observer.start()
 
         while True:
-            time.sleep(5)
+            wakeup.wait()
+
+            # Changes often come in bursts, such as when a directory is
+            # copied. Wait for them to settle down before syncing, but not
+            # forever if a file is being continuously written to.
+            settle_start = time.monotonic()
+            wakeup.clear()
+            while wakeup.wait(timeout=WATCH_SETTLE_TIME) and \
+                    time.monotonic() - settle_start < WATCH_MAX_SETTLE_TIME:
+                wakeup.clear()
+            wakeup.clear()
 
-            #XXX event_handler.updated_paths updated asynchronously?
             for event_handler in event_handlers:
-                for path in event_handler.updated_paths:
-                    event_handler.root.inspect_path_for_changes(path)
-                event_handler.updated_paths = set()
+                # Swap in a new set so paths added while we inspect aren't
+                # lost. They'll be picked up next time around.
+                with event_handler.lock:
+                    updated_paths = event_handler.updated_paths
+                    event_handler.updated_paths = set()
+                # Paths are inspected one at a time here, so hashing a large
+                # file can use several threads.
+                for path in updated_paths:
+                    event_handler.root.inspect_path_for_changes(
+                        path, multithreaded=True)
 
             self.sync(trust_previous_sync=True)
+
+
+def get_filesystem_type(path):
+    """
+    Return the type of filesystem `path` is on, such as "ext4", as listed in
+    "/proc/mounts". Returns None if it can't be found.
+    """
+    path = os.path.realpath(path)
+    try:
+        with open("/proc/mounts") as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+
+    # Use the longest mount point containing the path
+    best_mount_point = None
+    fs_type = None
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        # Spaces and such are escaped as octal, for example "\040"
+        mount_point = re.sub(
+            r"\\([0-7]{3})",
+            lambda match: chr(int(match.group(1), 8)),
+            fields[1]
+        )
+        if path != mount_point and \
+                not path.startswith(mount_point.rstrip(os.sep) + os.sep):
+            continue
+        if best_mount_point is None or len(mount_point) > len(best_mount_point):
+            best_mount_point = mount_point
+            fs_type = fields[2]
+    return fs_type
@@ -1,44 +1,272 @@
 import os
+import sys
+import errno
 import shutil
 import hashlib
-import random
 import json
 import stat
-import string
+import tempfile
+import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import blake3
+    _has_blake3 = True
+except ImportError:
+    _has_blake3 = False
+
 logger = logging.getLogger(__name__)
 
-SAFE_FILENAME_CHARS = string.ascii_lowercase + string.digits + "-"
+# Directory inside each root where its state is kept. It's never synced.
+HIDDEN_DIR = ".syncstate"
+
+# Hash used to detect changes to file contents. It doesn't need to be
+# cryptographically strong, just fast; BLAKE2b is faster than MD5 on 64-bit
+# CPUs, and BLAKE3 is faster still when the `blake3` package is installed.
+# Saved hashes are tagged with this name, so they're recomputed if it changes
+# (including when `blake3` is installed or removed).
+HASH_ALGORITHM = "blake3" if _has_blake3 else "blake2b-128"
+
+# Max number of files hashed at once while inspecting a root.
+HASH_THREADS = min(8, os.cpu_count() or 1)
+
+# Once the state journal is larger than this fraction of the state snapshot,
+# the next write compacts it into a new snapshot. See `SyncState`.
+JOURNAL_COMPACT_RATIO = 0.25
+
+# Flushes file data without also flushing unrelated metadata, like mtime.
+fdatasync = getattr(os, "fdatasync", os.fsync)
+
+# ioctl which makes one file share another's data on copy-on-write
+# filesystems, such as btrfs and XFS. From linux/fs.h.
+FICLONE = 0x40049409
+
+# Max bytes per `os.copy_file_range()` or `os.sendfile()` call.
+KERNEL_COPY_SIZE = 1 << 30
+
+# Bytes per read when copying or hashing file data through userspace.
+BUFFER_SIZE = 1 << 20
+
+# Errors meaning a way of copying isn't supported for the given files.
+COPY_UNSUPPORTED_ERRNOS = {
+    errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.ENOTSUP, errno.EOPNOTSUPP,
+    errno.ENOTSOCK,
+}
+
+# Coarsest timestamp resolution we expect from a filesystem (FAT uses 2
+# seconds). Directory timestamps closer than this to the previous scan aren't
+# trusted to detect new paths.
+DIR_MTIME_GRANULARITY_NS = 2 * 10**9
+
+def list_paths(root, unchanged_dirs=None):
+    """
+    Yield `(path, entry)` for everything inside `root`, where `path` is
+    relative to `root` and `entry` is the `os.DirEntry` found while listing.
+
+    `unchanged_dirs` maps relative directory paths whose listing is known not
+    to have changed to a list of their subdirectories. These directories are
+    not listed and their direct children are not yielded, but the given
+    subdirectories are still descended into.
+    """
+    if unchanged_dirs is None:
+        unchanged_dirs = {}
+
+    # Relative paths are built by concatenation, and directories are listed
+    # using the absolute path from their entry, so no joining is needed.
+    stack = [("", root)]
+    while stack:
+        dir_path, dir_abspath = stack.pop()
+        if dir_path in unchanged_dirs:
+            stack.extend((subdir, os.path.join(root, subdir))
+                         for subdir in unchanged_dirs[dir_path])
+            continue
+        prefix = dir_path + os.sep if dir_path else ""
+        with os.scandir(dir_abspath) as it:
+            for entry in it:
+                path = prefix + entry.name
+                yield path, entry
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((path, entry.path))
+
+def copy_file(source_abspath, dest_abspath, source_fd=None, hash_obj=None):
+    """
+    Copy the contents and mode of regular file `source_abspath` to
+    `dest_abspath`, letting the kernel move the data where possible.
+
+    If `source_fd` is given, it's an already open file descriptor of
+    `source_abspath` to read from. Its file position isn't used or changed,
+    so it can be shared between threads.
 
-def list_paths(root):
-    for cwd, dirs, paths in os.walk(root):
-        for f in dirs + paths:
-            absolute_path = os.path.join(cwd, f)
-            yield os.path.relpath(absolute_path, root)
+    If `hash_obj` is given, it's updated with the copied data.
+    """
+    if source_fd is None:
+        source_fd = os.open(source_abspath, os.O_RDONLY)
+        try:
+            return copy_file(source_abspath, dest_abspath, source_fd,
+                             hash_obj)
+        finally:
+            os.close(source_fd)
+
+    dest_fd = os.open(dest_abspath, os.O_RDWR | os.O_CREAT | os.O_TRUNC,
+                      0o600)
+    try:
+        copy_file_data(source_fd, dest_fd, hash_obj)
+        os.fchmod(dest_fd, stat.S_IMODE(os.fstat(source_fd).st_mode))
+    finally:
+        os.close(dest_fd)
+
+def copy_file_data(source_fd, dest_fd, hash_obj=None):
+    """
+    Copy everything in `source_fd` to the current position of `dest_fd`.
+    `source_fd` is read at explicit offsets, so its position isn't changed.
+
+    Tries, in order: cloning the data on copy-on-write filesystems, which is
+    instant; copying in the kernel with `os.copy_file_range()` or
+    `os.sendfile()`, which skips copying through userspace; then plain reads
+    and writes.
+
+    If `hash_obj` is given, it's updated with the copied data. Plain reads and
+    writes hash the data as it passes through. Clones and kernel copies never
+    bring the data into userspace, so `dest_fd` (which must be readable) is
+    read afterwards to hash it. A fresh copy is usually still in the page
+    cache.
+    """
+    if fcntl is not None and sys.platform.startswith("linux"):
+        try:
+            fcntl.ioctl(dest_fd, FICLONE, source_fd)
+        except OSError:
+            pass
+        else:
+            if hash_obj is not None:
+                hash_fd(dest_fd, hash_obj)
+            return
+
+    kernel_copies = []
+    if hasattr(os, "copy_file_range"):
+        kernel_copies.append(lambda offset: os.copy_file_range(
+            source_fd, dest_fd, KERNEL_COPY_SIZE, offset))
+    if sys.platform.startswith("linux"):
+        # Other platforms only support sending to sockets
+        kernel_copies.append(lambda offset: os.sendfile(
+            dest_fd, source_fd, offset, KERNEL_COPY_SIZE))
+    source_size = os.fstat(source_fd).st_size
+    for kernel_copy in kernel_copies:
+        offset = 0
+        try:
+            while True:
+                copied = kernel_copy(offset)
+                if not copied:
+                    break
+                offset += copied
+        except OSError as e:
+            # Only fall back if nothing has been copied yet.
+            if offset or e.errno not in COPY_UNSUPPORTED_ERRNOS:
+                raise
+            continue
+        if not offset and source_size:
+            # Some filesystems report that nothing is left to copy instead of
+            # failing, so an empty result for a non-empty file is treated as
+            # unsupported.
+            continue
+        if hash_obj is not None:
+            hash_fd(dest_fd, hash_obj)
+        return
+
+    offset = 0
+    while True:
+        buf = os.pread(source_fd, BUFFER_SIZE, offset)
+        if not buf:
+            return
+        offset += len(buf)
+        if hash_obj is not None:
+            hash_obj.update(buf)
+        view = memoryview(buf)
+        while view:
+            view = view[os.write(dest_fd, view):]
+
+def hash_fd(fd, hash_obj):
+    """
+    Update `hash_obj` with everything in `fd`, read at explicit offsets.
+    """
+    offset = 0
+    while True:
+        buf = os.pread(fd, BUFFER_SIZE, offset)
+        if not buf:
+            return
+        offset += len(buf)
+        hash_obj.update(buf)
 
-def path_in_dir(path, dir_path):
-    if not os.path.isabs(path) or not os.path.isabs(dir_path):
-        raise ValueError("path and dir_path must both be absolute")
-    path = os.path.normpath(path)
-    dir_path = os.path.normpath(dir_path)
+def stat_key(stat):
+    """
+    Return the parts of a StatResult which are compared to detect changes.
+    """
+    # Only include attributes of StatResult which are important to detecting
+    # changes. Here are some options that could make sense:
+    #
+    #   * mode: We want to sync at least some mode information (ex:
+    #           executable), but updating the mode doesn't change the
+    #           size or mtime.
+    #   * inode: May produce false positives on network file systems. Won't
+    #            catch anything that ctime or mtime wouldn't catch.
+    #   * uid/gid: Whenever this updates, mtime/ctime will update anyways.
+    #   * size: No reason not to include this. It could catch some false
+    #           negatives in obscure race conditions (another process
+    #           writing to a file at the same time we're syncing it),
+    #           although if the file size is the same it can't catch that
+    #           case.
+    #   * atime: Modified when file is accessed (depending on the
+    #            filesystem). This could produce a ton of false positives.
+    #   * mtime: Modified when file contents are changed. Can be set by
+    #            user.
+    #   * ctime: Nice because it's not user modifyable, but it updates
+    #            whenever atime updates, so it has the same problems.
+    #
+    # We'll use mtime, size, and mode. mtime catches most cases, mode will
+    # catch cases when the file contens haven't changed but the mode does,
+    # and size is safe to include and may catch edge cases.
+    #
+    # See more discussion in [Borg issue #911]
+    # (https://github.com/borgbackup/borg/issues/911)
+    if stat is None:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_mode)
+
+def new_hash(multithreaded=False):
+    """
+    Return a new hash object for `HASH_ALGORITHM`.
 
-    common_path = os.path.commonpath((path, dir_path))
-    return common_path.endswith(dir_path)
+    If `multithreaded=True`, large updates may be hashed on several threads.
+    Only use this when nothing else is being hashed at the same time, or the
+    threads will compete for the same CPUs.
+    """
+    if _has_blake3:
+        if multithreaded:
+            return blake3.blake3(max_threads=blake3.blake3.AUTO)
+        return blake3.blake3()
+    return hashlib.blake2b(digest_size=16)
 
-def get_file_hash(abspath, stat_result=None):
+def get_file_hash(abspath, stat_result=None, multithreaded=False):
     if not stat_result:
         stat_result = StatResult(os.stat(abspath, follow_symlinks=False))
-    h = hashlib.md5()
+    h = new_hash(multithreaded)
 
     if stat_result.is_link:
-        target = os.readlink(abspath)
-        h.update(target.encode())
+        # Reading the target as bytes skips decoding and re-encoding it, and
+        # works for targets that aren't valid UTF-8.
+        h.update(os.readlink(os.fsencode(abspath)))
     elif stat_result.is_regular:
-        with open(abspath, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                h.update(chunk)
+        fd = os.open(abspath, os.O_RDONLY)
+        try:
+            hash_fd(fd, h)
+        finally:
+            os.close(fd)
     else:
         raise NotImplementedError()
 
@@ -94,8 +322,9 @@ class SyncRoot:
 
     def __init__(self, root_path):
         self.root_path = os.path.abspath(root_path)
-        self._hidden_dir = os.path.join(self.root_path, ".syncstate")
+        self._hidden_dir = os.path.join(self.root_path, HIDDEN_DIR)
         self._state_file_path = os.path.join(self._hidden_dir, "state")
+        self._journal_file_path = os.path.join(self._hidden_dir, "journal")
         self._tmp_path = os.path.join(self._hidden_dir, "tmp")
 
         if not os.path.exists(self.root_path):
@@ -106,16 +335,21 @@ class SyncRoot:
 
         # `self.state` is an instance of SyncState which contains everything
         # tracked between invocations of the program.
-        self.state = SyncState(self._state_file_path)
+        self.state = SyncState(self._state_file_path, self._journal_file_path)
 
         # Dict of changed paths not yet committed to `self.state`.
         # Type: {path: ("created"|"updated"|"deleted", None|StatResult)}
         self.changes = {}
 
+        # If set, called as `change_callback(root, path, action)` whenever a
+        # change is added to `self.changes`.
+        self.change_callback = None
+
     def __str__(self):
         return f"<Root {self.root_path}>"
 
-    def _atomic_copy(self, source_abspath, dest_abspath, do_hash=False):
+    def _atomic_copy(self, source_abspath, dest_abspath, do_hash=False,
+                     source_fd=None):
         """
         Copy from source to dest atomically by copying to a temporary file then
         moving it.
@@ -124,14 +358,23 @@ class SyncRoot:
         `self.root_path`! Otherwise the move may not be atomic.
 
         If `do_hash=True` then the hash of the copied file will be returned.
+
+        `source_fd` is passed on to `copy_file()` for regular files.
         """
         file_hash = None
         with self._temp_file() as temp_abspath:
-            shutil.copy(source_abspath, temp_abspath, follow_symlinks=False)
-            if do_hash:
-                #TODO: Hash while copying
-                file_hash = get_file_hash(temp_abspath)
-            shutil.move(temp_abspath, dest_abspath)
+            if os.path.islink(source_abspath):
+                # The temp file already exists, and a symlink can't replace it
+                os.remove(temp_abspath)
+                os.symlink(os.readlink(source_abspath), temp_abspath)
+                if do_hash:
+                    file_hash = get_file_hash(temp_abspath)
+            else:
+                hash_obj = new_hash() if do_hash else None
+                copy_file(source_abspath, temp_abspath, source_fd, hash_obj)
+                if do_hash:
+                    file_hash = hash_obj.hexdigest()
+            os.replace(temp_abspath, dest_abspath)
         return file_hash
 
     def _atomic_write(self, dest_abspath, content):
@@ -146,50 +389,62 @@ class SyncRoot:
         with self._temp_file() as temp_abspath:
             with open(temp_abspath, 'wb') as f:
                 f.write(content)
-            shutil.move(temp_abspath, dest_abspath)
+            os.replace(temp_abspath, dest_abspath)
 
     @contextmanager
     def _temp_file(self):
         """
-        Context manager to make a temporary filename and ensure it's deleted
-        when finished.
+        Context manager to make a temporary file, which is expected to be
+        moved into place before exiting. It's deleted if an exception is
+        raised instead.
         """
 
-        # Generate unique filename
-        for i in range(100):
-            filename = ''.join(random.choices(SAFE_FILENAME_CHARS, k=20))
-            abspath = os.path.join(self._tmp_path, filename)
-            if not os.path.exists:
-                break
-        if os.path.exists(abspath):
-            raise FileExistsError("Could not find temp filename that isn't taken.")
-
-        yield abspath
+        # Creating the file reserves a unique name in a single call.
+        fd, abspath = tempfile.mkstemp(dir=self._tmp_path)
+        os.close(fd)
 
-        # Remove temp file when done
         try:
-            os.remove(abspath)
-        except FileNotFoundError:
-            pass
+            yield abspath
+        except BaseException:
+            try:
+                os.remove(abspath)
+            except FileNotFoundError:
+                pass
+            raise
 
     def write_state(self):
         """Write the internal state to permenant storage."""
         assert len(self.changes) == 0, "All changes must be resolved before " \
                                        "saving state."
-        if self.state.modified:
-            self._atomic_write(
-                self._state_file_path,
-                self.state.serialize()
-            )
-            self.state.modified = False
+        if not self.state.modified:
+            return
+
+        if self.state.should_compact():
+            # Write a full snapshot. Any journal left behind if we crash
+            # before removing it belongs to the old generation and is ignored.
+            self.state.new_generation()
+            content = self.state.serialize()
+            self._atomic_write(self._state_file_path, content)
+            try:
+                os.remove(self._journal_file_path)
+            except FileNotFoundError:
+                pass
+            self.state.snapshot_written(len(content))
+        else:
+            # Only append what changed since the last write.
+            entry = self.state.serialize_journal_entry()
+            with open(self._journal_file_path, "ab") as f:
+                f.write(entry)
+                f.flush()
+                fdatasync(f.fileno())
+            self.state.journal_written(len(entry))
 
     def abspath(self, path):
         """Return the absolute path of the given path."""
-        abspath = os.path.abspath(
-            os.path.join(self.root_path, path)
-        )
-        assert path_in_dir(abspath, self.root_path)
-        return abspath
+        # Paths are relative and normalized, so joining them is enough.
+        assert not os.path.isabs(path) and \
+            path.partition(os.sep)[0] != os.pardir
+        return os.path.join(self.root_path, path)
 
     def stat(self, path):
         """Return a StatResult object of the path."""
@@ -207,8 +462,10 @@ class SyncRoot:
         """
         Return True if no changes should ever be detected from the given path.
         """
-        abspath = self.abspath(path)
-        return path_in_dir(abspath, self._hidden_dir) or abspath == self.root_path
+        # Paths are relative and normalized, so checking them is just string
+        # comparisons.
+        return path in ("", ".", HIDDEN_DIR) or \
+            path.startswith(HIDDEN_DIR + os.sep)
 
     def inspect_root_for_changes(self, force_hash=False):
         """
@@ -216,103 +473,235 @@ class SyncRoot:
         they are different.
         """
 
+        scan_time_ns = time.time_ns()
+
+        # A directory's mtime and ctime change whenever an entry is added,
+        # removed or renamed inside of it, so if they match the previous sync
+        # we don't need to list it again to find new paths. The mtime alone
+        # isn't enough, since it can be set back afterwards (`tar x`, `rsync
+        # -t` and `cp -p` all do this), but doing so updates the ctime. The
+        # times are only trusted if they were recorded comfortably before the
+        # previous scan started. Otherwise a path created just after we
+        # listed the directory may have left them unchanged, as timestamps
+        # are coarse.
+        old_dir_times = {}
+        if not force_hash:
+            trusted_before = self.state.get("scan_time_ns", 0) - \
+                    DIR_MTIME_GRANULARITY_NS
+            for path in self.state.paths():
+                old_stat = self.state.path_get_stat(path)
+                if old_stat and old_stat.is_dir and \
+                        old_stat.st_mtime_ns < trusted_before and \
+                        old_stat.st_ctime_ns < trusted_before:
+                    old_dir_times[path] = (old_stat.st_mtime_ns,
+                                           old_stat.st_ctime_ns)
+
         # Inspect all paths in previous state, to see if they've been modified
         # or deleted.
-        inspected_paths = set()
+        #
+        # Most paths are unchanged, so they're checked against the saved stat
+        # list first, without building StatResult objects or calling into
+        # `inspect_path_for_changes()`. This compares the same fields as
+        # `stat_key()`, plus the ctime of directories, which the directory
+        # check below relies on.
+        saved_stats = self.state["stats"]
+        saved_hashes = self.state["hashes"]
+        changed = []
         for path in self.state.paths():
-            self.inspect_path_for_changes(path, force_hash=force_hash)
-            inspected_paths.add(path)
-
-        # List all paths inside the root and inspect them if they haven't been.
-        for path in list_paths(self.root_path):
-            if path not in inspected_paths:
+            try:
+                st = os.stat(os.path.join(self.root_path, path),
+                             follow_symlinks=False)
+            except (FileNotFoundError, NotADirectoryError):
+                # Deleted. See `stat()`.
                 self.inspect_path_for_changes(path, force_hash=force_hash)
+                continue
+            mode, size, mtime_ns, ctime_ns = saved_stats[path]
+            if not force_hash and st.st_mtime_ns == mtime_ns and \
+                    st.st_size == size and st.st_mode == mode:
+                if stat.S_ISDIR(mode):
+                    if st.st_ctime_ns == ctime_ns:
+                        continue
+                elif path in saved_hashes:
+                    continue
+            changed.append((path, st))
+        self._inspect_stat_results(changed, force_hash)
+
+        # Find directories which are unchanged since the previous sync, along
+        # with the subdirectories we still have to descend into.
+        unchanged_dirs = {}
+        for path, times in old_dir_times.items():
+            stat_info = self.state.path_get_stat(path)
+            if stat_info and stat_info.is_dir and \
+                    (stat_info.st_mtime_ns, stat_info.st_ctime_ns) == times:
+                unchanged_dirs[path] = []
+        for path in self.state.paths():
+            parent = os.path.dirname(path)
+            if parent in unchanged_dirs:
+                stat_info = self.state.path_get_stat(path)
+                if stat_info and stat_info.is_dir:
+                    unchanged_dirs[parent].append(path)
+
+        # List all paths inside the root and inspect the ones that aren't in
+        # the state, so weren't inspected above. Directories that haven't
+        # changed aren't listed, so each path is stat'd only once overall.
+        created = []
+        for path, entry in list_paths(self.root_path, unchanged_dirs):
+            if path not in saved_stats and \
+                    not self.should_ignore_path(path):
+                try:
+                    created.append((path, entry.stat(follow_symlinks=False)))
+                except FileNotFoundError:
+                    # Deleted since it was listed
+                    continue
+        self._inspect_stat_results(created, force_hash)
+
+        # Not marked as modified on purpose. If the state isn't written, the
+        # older scan time saved on disk is only more conservative.
+        self.state["scan_time_ns"] = scan_time_ns
+
+    def _inspect_stat_results(self, items, force_hash):
+        """
+        Inspect each `(path, os.stat_result)` in `items`, whose regular files
+        are first hashed several at a time.
+        """
+        hashes = self._hash_files(items)
+        for path, st in items:
+            self.inspect_path_for_changes(path, force_hash=force_hash,
+                                          stat_info=StatResult(st),
+                                          file_hash=hashes.get(path))
 
-    def inspect_path_for_changes(self, path, force_hash=False):
+    def _hash_files(self, items):
+        """
+        Return `{path: hash}` for the regular files among `(path,
+        os.stat_result)` pairs in `items`, hashed in parallel threads.
+
+        Files are hashed in inode order, which roughly follows their layout on
+        disk. Files that fail to hash are left out, so the error is raised
+        again, or handled, when they're inspected.
+        """
+        files = sorted(
+            (st.st_ino, path, StatResult(st)) for path, st in items
+            if stat.S_ISREG(st.st_mode)
+        )
+        if len(files) < 2:
+            return {}
+
+        def hash_file(file):
+            _, path, stat_info = file
+            try:
+                return get_file_hash(self.abspath(path), stat_info)
+            except OSError:
+                return None
+
+        with ThreadPoolExecutor(max_workers=HASH_THREADS) as executor:
+            hashes = executor.map(hash_file, files)
+            return {
+                path: file_hash
+                for (_, path, _), file_hash in zip(files, hashes)
+                if file_hash is not None
+            }
+
+    def inspect_path_for_changes(self, path, force_hash=False,
+                                 stat_info=None, file_hash=None,
+                                 multithreaded=False):
         """
         Compare the given path to internal state and add to `self.changes` if
         they are different.
+
+        `stat_info` may be given if the path was just stat'd by the caller, in
+        which case the path isn't stat'd again. Likewise, `file_hash` may be
+        given if the path was just hashed.
+
+        `multithreaded` is passed on to `get_file_hash()`. Only set it if
+        nothing else is hashing at the same time.
         """
         if self.should_ignore_path(path):
             return
         abspath = self.abspath(path)
 
-        # Only include attributes of StatResult which are important to detecing
-        # changes. Here are some options that could make sense:
-        #
-        #   * mode: We want to sync at least some mode information (ex:
-        #           executable), but updating the mode doesn't change the
-        #           size or mtime.
-        #   * inode: May produce false positives on network file systems. Won't
-        #            catch anything that ctime or mtime wouldn't catch.
-        #   * uid/gid: Whenever this updates, mtime/ctime will update anyways.
-        #   * size: No reason not to include this. It could catch some false
-        #           negatives in obscure race conditions (another process
-        #           writing to a file at the same time we're syncing it),
-        #           although if the file size is the same it can't catch that
-        #           case.
-        #   * atime: Modified when file is accessed (depending on the
-        #            filesystem). This could produce a ton of false positives.
-        #   * mtime: Modified when file contents are changed. Can be set by
-        #            user.
-        #   * ctime: Nice because it's not user modifyable, but it updates
-        #            whenever atime updates, so it has the same problems.
-        #
-        # We'll use mtime, size, and mode. mtime catches most cases, mode will
-        # catch cases when the file contens haven't changed but the mode does,
-        # and size is safe to include and may catch edge cases.
-        #
-        # See more discussion in [Borg issue #911]
-        # (https://github.com/borgbackup/borg/issues/911)
-        def get_important_stat_info(stat):
-            if stat is None:
-                return None
-            return (stat.st_mtime_ns, stat.st_size, stat.st_mode)
-
-        def stats_equal(stat1, stat2):
-            return get_important_stat_info(stat1) == get_important_stat_info(stat2)
-
         old_stat_info = self.state.path_get_stat(path)
-        stat_info = self.stat(path)
+        if stat_info is None:
+            stat_info = self.stat(path)
         if stat_info:
+            # See `stat_key()` for which parts of the stat are compared.
+            stats_equal = stat_key(stat_info) == stat_key(old_stat_info)
             # Path exists.
             # If file didn't used to exist. Make "created" change.
             if old_stat_info is None:
-                self.changes[path] = ("created", stat_info)
+                self._add_change(path, "created", stat_info)
                 if not stat_info.is_dir:
-                    self.state.path_set_hash(path, get_file_hash(abspath))
+                    self.state.path_set_hash(
+                        path, file_hash or get_file_hash(abspath, stat_info,
+                                                         multithreaded))
                 self.state.path_set_stat(path, stat_info)
                 logger.debug(f'{self} Detected created path "{path}"')
 
             # Path is directory
             elif stat_info.is_dir:
-                if not stats_equal(stat_info, old_stat_info):
-                    self.changes[path] = ("updated", stat_info)
+                if not stats_equal:
+                    self._add_change(path, "updated", stat_info)
                     self.state.path_set_hash(path, None)
                     self.state.path_set_stat(path, stat_info)
                     logger.debug(f'{self} Detected updated directory "{path}"')
+                elif stat_info.st_ctime_ns != old_stat_info.st_ctime_ns:
+                    # Nothing to sync, but save the ctime so the directory's
+                    # listing can be trusted again on the next scan.
+                    self.state.path_set_stat(path, stat_info)
 
             # If the file stat has changed, check the file hash and make a
-            # "updated" change if it's different.
-            elif not stats_equal(stat_info, old_stat_info) or force_hash:
-                current_hash = get_file_hash(abspath)
+            # "updated" change if it or the mode is different.
+            elif not stats_equal or force_hash:
+                current_hash = file_hash or \
+                    get_file_hash(abspath, stat_info, multithreaded)
                 saved_hash = self.state.path_get_hash(path)
-                if current_hash != saved_hash:
-                    self.changes[path] = ("updated", stat_info)
+                if current_hash != saved_hash or \
+                        stat_info.st_mode != old_stat_info.st_mode:
+                    self._add_change(path, "updated", stat_info)
                     self.state.path_set_hash(path, current_hash)
                     self.state.path_set_stat(path, stat_info)
                     logger.debug(f'{self} Detected updated file "{path}"')
+                elif not stats_equal:
+                    # Only touched. Save the stat so we don't hash it again.
+                    self.state.path_set_stat(path, stat_info)
+
+            # Saved hash was dropped because the hash algorithm changed. The
+            # file didn't change, so just recompute it.
+            elif self.state.path_get_hash(path) is None:
+                self.state.path_set_hash(
+                    path, file_hash or get_file_hash(abspath, stat_info,
+                                                     multithreaded))
         else:
             # File doesn't exist.
             # Make "deleted" change if it used to exist.
             if old_stat_info:
-                self.changes[path] = ("deleted", None)
+                self._add_change(path, "deleted", None)
                 self.state.path_delete(path)
                 logger.debug(f'{self} Detected deleted file "{path}"')
 
-    def remove_change(self, path):
+    def _add_change(self, path, action, stat_info):
+        self.changes[path] = (action, stat_info)
+        if self.change_callback:
+            self.change_callback(self, path, action)
+
+    def _has_contents(self, path, file_hash):
+        """
+        Return True if `path` is a regular file whose hash is `file_hash`.
+
+        Like `inspect_path_for_changes()`, the saved hash is trusted as long as
+        the stat hasn't changed since it was saved.
+        """
+        if file_hash is None or self.state.path_get_hash(path) != file_hash:
+            return False
+        stat_info = self.stat(path)
+        return stat_info is not None and stat_info.is_regular and \
+            stat_key(stat_info) == stat_key(self.state.path_get_stat(path))
+
+    def remove_change(self, path, force_hash=True):
         """
         Clear the `changes` attribute of changes for this path.
+
+        `force_hash=False` may be given if the path's hash and stat were just
+        saved from data this process wrote itself.
         """
         if path in self.changes:
             del self.changes[path]
@@ -320,20 +709,33 @@ class SyncRoot:
         # If path changed while processing, this will trigger another update.
         # Force hashing to check for changes, since another process may have
         # written to the same path at the same mtime.
-        self.inspect_path_for_changes(path, force_hash=True)
+        self.inspect_path_for_changes(path, force_hash=force_hash)
+
+    def perform_create(self, dest_path, source_abspath, source_hash=None):
+        self._perform_action("create", dest_path, source_abspath, source_hash)
+
+    def perform_update(self, dest_path, source_abspath, source_hash=None,
+                       source_fd=None):
+        """
+        Update `dest_path` to be a copy of `source_abspath`.
 
-    def perform_create(self, dest_path, source_abspath):
-        self._perform_action("create", dest_path, source_abspath)
+        If `source_hash` is given and matches the unchanged contents of
+        `dest_path`, only the mode is copied instead of the whole file.
 
-    def perform_update(self, dest_path, source_abspath):
-        self._perform_action("update", dest_path, source_abspath)
+        `source_fd` may be an open file descriptor of `source_abspath`, if it's
+        a regular file, so one can be shared when updating many roots.
+        """
+        self._perform_action("update", dest_path, source_abspath, source_hash,
+                             source_fd)
 
     def perform_delete(self, path):
         self._perform_action("delete", path)
 
-    def _perform_action(self, action, path, source_abspath=None):
+    def _perform_action(self, action, path, source_abspath=None,
+                        source_hash=None, source_fd=None):
         logger.debug(f'{self} Performing action {action} "{path}"')
         abspath = self.abspath(path)
+        force_hash = True
 
         # Perform action
         if action in ("create", "update"):
@@ -346,18 +748,23 @@ class SyncRoot:
             # the state to reflect this, and remove any changes. This can
             # happen anywhere on the path leading up to the path being
             # updated.
-            path_to_dir = os.path.relpath(os.path.dirname(abspath), self.root_path)
-            dir_path = os.path.split(path_to_dir)
-            for i in range(1, len(dir_path)+1):
-                partial_path = os.path.join(*dir_path[0:i])
-                partial_abspath = self.abspath(partial_path)
-                if os.path.isfile(partial_abspath):
-                    os.remove(partial_abspath)
-                if not os.path.exists(partial_abspath):
-                    os.makedirs(partial_abspath)
-                    self.state.path_set_hash(partial_path, None)
-                    self.state.path_set_stat(partial_path, self.stat(partial_path))
-                    self.remove_change(partial_path)
+            #
+            # Usually the directory already exists, which takes one stat to
+            # check. Otherwise each component is checked from the top down.
+            dir_path = os.path.dirname(path)
+            if dir_path and not os.path.isdir(self.abspath(dir_path)):
+                components = dir_path.split(os.sep)
+                for i in range(1, len(components)+1):
+                    partial_path = os.sep.join(components[:i])
+                    partial_abspath = self.abspath(partial_path)
+                    if os.path.isfile(partial_abspath):
+                        os.remove(partial_abspath)
+                    if not os.path.exists(partial_abspath):
+                        os.mkdir(partial_abspath)
+                        self.state.path_set_hash(partial_path, None)
+                        self.state.path_set_stat(partial_path,
+                                                 self.stat(partial_path))
+                        self.remove_change(partial_path)
 
             # Directories
             if os.path.isdir(source_abspath) and not os.path.islink(source_abspath):
@@ -368,6 +775,12 @@ class SyncRoot:
                 os.makedirs(abspath, exist_ok=True)
                 self.state.path_set_hash(path, None)
 
+            # Files with the same contents. Just copy the mode.
+            elif self._has_contents(path, source_hash) and \
+                    os.path.isfile(source_abspath) and \
+                    not os.path.islink(source_abspath):
+                shutil.copymode(source_abspath, abspath)
+
             # Files / Symlinks
             else:
                 if os.path.isdir(abspath):
@@ -375,8 +788,13 @@ class SyncRoot:
                     # file.
                     os.rmdir(abspath)
                 file_hash = self._atomic_copy(source_abspath, abspath,
-                                            do_hash=True)
+                                              do_hash=True,
+                                              source_fd=source_fd)
                 self.state.path_set_hash(path, file_hash)
+                # The copy was hashed while it was made, so there's no need
+                # to read it again. It's still rehashed if its stat differs
+                # from the one saved below.
+                force_hash = False
             self.state.path_set_stat(path, self.stat(path))
 
         elif action == "delete":
@@ -389,94 +807,272 @@ class SyncRoot:
             except FileNotFoundError:
                 pass
 
-        self.remove_change(path)
+        self.remove_change(path, force_hash=force_hash)
 
 
 class SyncState(dict):
     """The state data structure stored for a SyncRoot.
 
     This is just a dictionary with some helper methods to provide structure.
+
+    Per-path attributes are stored in columns rather than one dict per path:
+    `self["stats"]` maps each path to its serialized stat, and
+    `self["hashes"]` maps each path with a known hash to that hash. A path
+    exists in the state if it has a stat.
+
+    The state is stored as a full snapshot at `path`, plus a journal at
+    `journal_path`. Each write usually appends only the paths modified since
+    the previous write to the journal, as one JSON line. When the journal gets
+    large compared to the snapshot, a new snapshot is written instead.
+    Journal entries are tagged with the snapshot's generation, so entries
+    from before a snapshot are never replayed on top of it.
     """
 
-    def __init__(self, path):
-        if os.path.exists(path):
-            with open(path) as f:
-                state_dict = json.load(f)
-        else:
+    # Keys holding per-path columns, as opposed to metadata about the state.
+    COLUMNS = ("stats", "hashes")
+
+    def __init__(self, path, journal_path):
+        # Read as bytes, which json parses directly, so the snapshot size is
+        # that of what was parsed without another stat.
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
             state_dict = {}
+            self._snapshot_size = None
+        else:
+            state_dict = json.loads(content)
+            self._snapshot_size = len(content)
         super().__init__(state_dict)
-        self.setdefault("paths", {})
+        self.setdefault("stats", {})
+        self.setdefault("hashes", {})
+        self.setdefault("generation", 0)
         self.modified = False
 
+        # Paths modified since the last write
+        self._modified_paths = set()
+
+        # Set when the next write must be a full snapshot
+        self._needs_snapshot = False
+
+        # Older states stored a dict of attributes for each path.
+        for path, path_attrs in self.pop("paths", {}).items():
+            self._load_path_attrs(path, path_attrs)
+            self.modified = True
+
+        self._journal_size = 0
+        if self._snapshot_size is not None:
+            self._replay_journal(journal_path)
+
+        # Hashes from another algorithm can't be compared to ours. Drop them
+        # so they're recomputed when the paths are inspected.
+        if self.get("hash_algorithm", "md5") != HASH_ALGORITHM:
+            self["hash_algorithm"] = HASH_ALGORITHM
+            if self["hashes"]:
+                self["hashes"].clear()
+                self.modified = True
+
+        # The changes above aren't tracked per path.
+        if self.modified:
+            self._needs_snapshot = True
+
+        # StatResult objects built by `path_get_stat()`, so repeated lookups
+        # of the same path don't rebuild them. Kept up to date by the
+        # `path_*` setters.
+        self._stat_cache = {}
+
+    def _load_path_attrs(self, path, path_attrs):
+        """Load a path stored in the older dict-per-path format."""
+        path_stat = path_attrs.get("stat")
+        if path_stat is None:
+            return
+        if isinstance(path_stat, dict):
+            # Even older states stored each stat as a dict.
+            path_stat = StatResult(path_stat).serialize()
+        self["stats"][path] = path_stat
+        if path_attrs.get("hash") is not None:
+            self["hashes"][path] = path_attrs["hash"]
+
+    def _replay_journal(self, journal_path):
+        try:
+            f = open(journal_path, "rb")
+        except FileNotFoundError:
+            return
+        stats = self["stats"]
+        hashes = self["hashes"]
+        with f:
+            for line in f:
+                self._journal_size += len(line)
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Partially written entry from a crash. Appending after
+                    # it would corrupt the next entry too.
+                    self._needs_snapshot = True
+                    break
+                if entry["generation"] != self["generation"]:
+                    continue
+                for path, path_stat in entry["stats"].items():
+                    path_hash = entry["hashes"].get(path)
+                    if path_stat is None:
+                        stats.pop(path, None)
+                    else:
+                        stats[path] = path_stat
+                    if path_hash is None:
+                        hashes.pop(path, None)
+                    else:
+                        hashes[path] = path_hash
+                self.update(entry["meta"])
+
     def serialize(self):
-        return json.dumps(self).encode()
+        return json.dumps(self, separators=(",", ":")).encode()
+
+    def serialize_journal_entry(self):
+        """Return a journal line with everything modified since last write."""
+        stats = self["stats"]
+        hashes = self["hashes"]
+        entry = {
+            "generation": self["generation"],
+            "meta": {key: value for key, value in self.items()
+                     if key not in self.COLUMNS},
+            "stats": {path: stats.get(path) for path in self._modified_paths},
+            "hashes": {path: hashes[path] for path in self._modified_paths
+                       if path in hashes},
+        }
+        return json.dumps(entry, separators=(",", ":")).encode() + b"\n"
+
+    def should_compact(self):
+        """Return True if the next write should be a full snapshot."""
+        return self._needs_snapshot or self._snapshot_size is None or \
+            self._journal_size > self._snapshot_size * JOURNAL_COMPACT_RATIO
+
+    def new_generation(self):
+        """Start a new generation, invalidating the existing journal."""
+        self["generation"] += 1
+
+    def snapshot_written(self, size):
+        """Record that a snapshot of `size` bytes was written."""
+        self._snapshot_size = size
+        self._journal_size = 0
+        self._needs_snapshot = False
+        self._modified_paths.clear()
+        self.modified = False
+
+    def journal_written(self, size):
+        """Record that a journal entry of `size` bytes was appended."""
+        self._journal_size += size
+        self._modified_paths.clear()
+        self.modified = False
+
+    def manifest_hash(self):
+        """
+        Return a hash of every path along with its type and content hash.
+
+        States with equal manifest hashes agree on everything that is compared
+        between roots when checking their metadata. The result doesn't depend
+        on the order paths were added in.
+        """
+        hashes = self["hashes"]
+        total = 0
+        for path, path_stat in self["stats"].items():
+            file_type = stat.S_IFMT(path_stat[0])
+            entry = f"{path}\0{file_type}\0{hashes.get(path)}"
+            digest = hashlib.blake2b(entry.encode(errors="surrogateescape"),
+                                     digest_size=16).digest()
+            total += int.from_bytes(digest, "little")
+        return total % (1 << 128)
 
     def paths(self):
         """Return a list of paths."""
-        return list(self["paths"].keys())
-
-    def _path_get_attr(self, path, attr):
-        path_attrs = self["paths"].get(path, None)
-        return path_attrs.get(attr, None) if path_attrs else None
+        return list(self["stats"].keys())
 
-    def _path_set_attr(self, path, attr, value):
+    def _path_modified(self, path):
         self.modified = True
-        if path not in self["paths"]:
-            self["paths"][path] = {}
-        self["paths"][path][attr] = value
+        self._modified_paths.add(path)
 
     def path_get_stat(self, path):
-        stat = self._path_get_attr(path, "stat")
-        return StatResult(stat) if stat else None
+        try:
+            return self._stat_cache[path]
+        except KeyError:
+            pass
+        stat = self["stats"].get(path)
+        stat = StatResult(stat) if stat else None
+        self._stat_cache[path] = stat
+        return stat
 
     def path_set_stat(self, path, stat_result):
-        self._path_set_attr(path, "stat", StatResult(stat_result))
+        # StatResults aren't modified once made, so one can be kept as is.
+        if isinstance(stat_result, StatResult):
+            stat = stat_result
+        else:
+            stat = StatResult(stat_result)
+        self["stats"][path] = stat.serialize()
+        self._stat_cache[path] = stat
+        self._path_modified(path)
 
     def path_get_hash(self, path):
-        return self._path_get_attr(path, "hash")
+        return self["hashes"].get(path)
 
     def path_set_hash(self, path, value):
-        self._path_set_attr(path, "hash", value)
+        if value is None:
+            self["hashes"].pop(path, None)
+        else:
+            self["hashes"][path] = value
+        self._path_modified(path)
 
     def path_delete(self, path):
-        self.modified = True
-        del self["paths"][path]
+        del self["stats"][path]
+        self["hashes"].pop(path, None)
+        self._stat_cache.pop(path, None)
+        self._path_modified(path)
+
 
+class StatResult:
+    """The info we're interested in from a path's stat.
 
-class StatResult(dict):
-    """A dict of the info we're interested from a path's stat.
+    The constructor can take a StatResult, a stat_result returned from
+    os.stat, or a dict of the fields stored by older versions. The resulting
+    StatResult can be serialized as a list with `serialize()`, which can then
+    be deserialized and turned into a new StatResult object by being passed
+    into the construtor.
 
-    The constructor can take a dict a StatResult dict, or a stat_result
-    returned from os.stat. The resulting StatResult can serialized as a
-    dictionary, which can then be deserialized and turned into a new StatResult
-    object by being passed into the construtor.
+    Fields are plain attributes in `__slots__`, since they're read in every
+    comparison while scanning a root.
     """
 
+    # atime isn't included, since reading a file changes it and it isn't used
+    # to detect changes.
     STAT_FIELDS = (
         "st_mode",
         "st_size",
-        "st_atime_ns",
         "st_mtime_ns",
         "st_ctime_ns",
     )
+    __slots__ = STAT_FIELDS
 
     def __init__(self, stat):
         """
-        Takes a stat_result returned from os.stat, or a dictionary previously
-        generated from a StatResult.
+        Takes a stat_result returned from os.stat, a StatResult, a dictionary
+        with the STAT_FIELDS keys, or a list from `StatResult.serialize()`.
         """
-        super().__init__()
-        for key in StatResult.STAT_FIELDS:
-            if hasattr(stat, key):
-                self[key] = getattr(stat, key)
-            elif key in stat:
-                self[key] = stat[key]
-
-    def __getattr__(self, name):
-        if name in StatResult.STAT_FIELDS:
-            return self.get(name, None)
+        if isinstance(stat, list):
+            self.st_mode, self.st_size, self.st_mtime_ns, self.st_ctime_ns = \
+                stat
+        elif isinstance(stat, dict):
+            for key in StatResult.STAT_FIELDS:
+                setattr(self, key, stat.get(key))
         else:
-            return self.get(name)
+            self.st_mode = stat.st_mode
+            self.st_size = stat.st_size
+            self.st_mtime_ns = stat.st_mtime_ns
+            self.st_ctime_ns = stat.st_ctime_ns
+
+    def serialize(self):
+        """Return a list of the stat fields, in the order of STAT_FIELDS."""
+        return [self.st_mode, self.st_size, self.st_mtime_ns, self.st_ctime_ns]
+
+    def __repr__(self):
+        return f"StatResult({self.serialize()})"
 
     @property
     def updated_time(self):
@@ -493,12 +1089,12 @@ class StatResult(dict):
 
     @property
     def is_regular(self):
-        return self.type == "regular"
+        return stat.S_ISREG(self.st_mode)
 
     @property
     def is_dir(self):
-        return self.type == "dir"
+        return stat.S_ISDIR(self.st_mode)
 
     @property
     def is_link(self):
-        return self.type == "link"
+        return stat.S_ISLNK(self.st_mode)
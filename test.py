@@ -1,24 +1,52 @@
 import os
 import sys
+import json
 import unittest
 import tempfile
 import shutil
 import stat
 import time
+import threading
+from unittest import mock
 
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
 from justsync import SyncRoot, Synchronizer
+from justsync.syncroot import get_file_hash, new_hash
 
-DEBUG = False
+DEBUG = bool(os.environ.get("JUSTSYNC_TEST_DEBUG"))
 if DEBUG:
     import logging
     root_logger = logging.getLogger()
     root_logger.setLevel(logging.DEBUG)
     root_logger.addHandler(logging.StreamHandler(sys.stdout))
 
+# Symlinks and permission bits need POSIX semantics.
+posix_only = unittest.skipUnless(os.name == "posix", "POSIX only")
+
 class TestSync(unittest.TestCase):
     _reverse_sync_order = False
 
+    @classmethod
+    def setUpClass(cls):
+        # Each test gets its own directory inside of this one.
+        cls._class_temp_dir = tempfile.mkdtemp()
+
+        # Symlink targets live outside of any root and are never modified, so
+        # tests share them.
+        targets = os.path.join(cls._class_temp_dir, "_symlink_targets")
+        cls.symlink_target_file = os.path.join(targets, "file1")
+        cls.symlink_target_file2 = os.path.join(targets, "file2")
+        cls.symlink_target_dir = os.path.join(targets, "dir")
+        os.makedirs(cls.symlink_target_dir)
+        with open(cls.symlink_target_file, 'w') as f:
+            f.write("Target Contents")
+        with open(cls.symlink_target_file2, 'w') as f:
+            f.write("Target Contents 2")
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls._class_temp_dir)
+
     def setUp(self):
         self.temp_dir_base = None
         self._temp_dirs = []
@@ -31,15 +59,12 @@ class TestSync(unittest.TestCase):
 
     def make_temp_dir(self):
         if not self.temp_dir_base:
-            self.temp_dir_base = tempfile.mkdtemp()
+            self.temp_dir_base = os.path.join(self._class_temp_dir,
+                                              self._testMethodName)
+            os.mkdir(self.temp_dir_base)
 
-        i = 0
-        path = os.path.join(self.temp_dir_base, str(i))
-        while os.path.exists(path):
-            i += 1
-            path = os.path.join(self.temp_dir_base, str(i))
-
-        os.makedirs(path)
+        path = os.path.join(self.temp_dir_base, str(len(self._temp_dirs)))
+        os.mkdir(path)
         self._temp_dirs.append(path)
         return path
 
@@ -50,14 +75,12 @@ class TestSync(unittest.TestCase):
     def write_file(self, root_path, path, content=""):
         full_path = os.path.join(root_path, path)
         os.makedirs(os.path.dirname(full_path), exist_ok=True)
-        with open(full_path, "w") as f:
-            f.write(content)
-        self.assertFilePresent(root_path, path)
+        with open(full_path, "wb", buffering=0) as f:
+            f.write(content.encode())
 
     def delete_file(self, root_path, path):
         full_path = os.path.join(root_path, path)
         os.remove(full_path)
-        self.assertFileAbsent(root_path, path)
 
     def write_dir(self, root_path, path):
         full_path = os.path.join(root_path, path)
@@ -90,25 +113,35 @@ class TestSync(unittest.TestCase):
     def assertFile(self, root_path, path, expected_content):
         """Assert contents of `path` in `root_path` are `expected_content`."""
         full_path = os.path.join(root_path, path)
-        self.assertFilePresent(root_path, path)
-        with open(full_path) as f:
-            content = f.read()
+        try:
+            with open(full_path, "rb", buffering=0) as f:
+                content = f.read().decode()
+        except FileNotFoundError:
+            self.fail(f"{path} not present in {root_path}")
         self.assertEqual(content, expected_content)
 
     def assertFilePresent(self, root_path, path):
         """Assert `path` is present in `root_path`."""
         full_path = os.path.join(root_path, path)
-        self.assertTrue(os.path.exists(full_path))
+        try:
+            os.stat(full_path)
+        except FileNotFoundError:
+            self.fail(f"{path} not present in {root_path}")
 
     def assertFileAbsent(self, root_path, path):
         """Assert `path` is not present in `root_path`."""
         full_path = os.path.join(root_path, path)
-        self.assertFalse(os.path.exists(full_path))
+        self.assertFalse(os.access(full_path, os.F_OK))
+
+    def assertSymlink(self, root_path, path, target):
+        """Assert `path` in `root_path` is a symlink pointing to `target`."""
+        full_path = os.path.join(root_path, path)
+        self.assertTrue(stat.S_ISLNK(os.lstat(full_path).st_mode))
+        self.assertEqual(os.readlink(full_path), target)
 
     def assertDirPresent(self, root_path, path):
         """Assert `path` is a directory in `root_path`."""
         full_path = os.path.join(root_path, path)
-        self.assertTrue(os.path.exists(full_path))
         self.assertTrue(os.path.isdir(full_path))
 
     ########## Tests ##########
@@ -140,14 +173,95 @@ class TestSync(unittest.TestCase):
         self.sync_all()
 
         self.write_file(dir0, "foo", "baz")
-        # Force hash here because there is technically a race condition if the
-        # mtime written by the first sync is the same as the mtime written by
-        # the file-write directly after.
-        self.sync_all(force_hash=True)
+        # The rewrite can land in the same timestamp tick as the first sync
+        # saw, with the same size. Move mtime so the stat comparison is
+        # guaranteed to notice the change without forcing a hash.
+        old_time = time.time() - 60
+        os.utime(os.path.join(dir0, "foo"), (old_time, old_time))
+        self.sync_all()
 
         self.assertFile(dir0, "foo", "baz")
         self.assertFile(dir1, "foo", "baz")
 
+    def test_hash_algorithm_change(self):
+        """Hashes saved by another algorithm are recomputed, not synced."""
+        dir0, dir1 = self.make_temp_dirs(2)
+        self.write_file(dir0, "foo", "bar")
+        self.sync_all()
+
+        for d in [dir0, dir1]:
+            root = SyncRoot(d)
+            root.state["hash_algorithm"] = "md5"
+            root.state.path_set_hash("foo", "37b51d194a7513e45b56f6524f2d51f2")
+            root.write_state()
+
+        for d in [dir0, dir1]:
+            root = SyncRoot(d)
+            root.inspect_root_for_changes()
+            self.assertEqual(root.changes, {})
+            self.assertEqual(
+                root.state.path_get_hash("foo"),
+                get_file_hash(os.path.join(d, "foo"))
+            )
+
+    def test_blake3_threads(self):
+        """BLAKE3 only hashes on several threads when asked to."""
+        blake3 = mock.Mock()
+        with mock.patch("justsync.syncroot._has_blake3", True), \
+                mock.patch("justsync.syncroot.blake3", blake3, create=True):
+            new_hash()
+            blake3.blake3.assert_called_with()
+            new_hash(multithreaded=True)
+            blake3.blake3.assert_called_with(max_threads=blake3.blake3.AUTO)
+
+    def test_state_journal(self):
+        """State appended to the journal is read back."""
+        dir0, dir1 = self.make_temp_dirs(2)
+        self.write_file(dir0, "foo", "bar")
+        self.sync_all()
+        self.write_file(dir0, "baz", "qux")
+        self.sync_all()
+        self.assertFilePresent(dir1, ".syncstate/journal")
+        root = SyncRoot(dir1)
+        self.assertEqual(set(root.state.paths()), {"foo", "baz"})
+
+        # A partially written entry is ignored, and the next write replaces
+        # the journal with a new snapshot.
+        with open(os.path.join(dir1, ".syncstate/journal"), "ab") as f:
+            f.write(b'{"generation":')
+        root = SyncRoot(dir1)
+        self.assertEqual(set(root.state.paths()), {"foo", "baz"})
+        self.write_file(dir0, "quux", "")
+        self.sync_all()
+        self.assertFileAbsent(dir1, ".syncstate/journal")
+        root = SyncRoot(dir1)
+        self.assertEqual(set(root.state.paths()), {"foo", "baz", "quux"})
+
+    def test_old_state_format(self):
+        """State stored as a dict of attributes per path is still read."""
+        dir0, dir1 = self.make_temp_dirs(2)
+        self.write_file(dir0, "foo", "bar")
+        self.sync_all()
+
+        root = SyncRoot(dir0)
+        old_state = {
+            "hash_algorithm": root.state["hash_algorithm"],
+            "paths": {
+                path: {"stat": root.state["stats"][path],
+                       "hash": root.state.path_get_hash(path)}
+                for path in root.state.paths()
+            },
+        }
+        with open(os.path.join(dir0, ".syncstate/state"), "w") as f:
+            json.dump(old_state, f)
+        self.assertFileAbsent(dir0, ".syncstate/journal")
+
+        root = SyncRoot(dir0)
+        root.inspect_root_for_changes()
+        self.assertEqual(root.changes, {})
+        self.assertEqual(root.state.path_get_hash("foo"),
+                         get_file_hash(os.path.join(dir0, "foo")))
+
     def test_file_delete(self):
         dir0, dir1 = self.make_temp_dirs(2)
         self.write_file(dir0, "foo", "bar")
@@ -172,6 +286,26 @@ class TestSync(unittest.TestCase):
         with self.assertRaises(ValueError):
             Synchronizer(SyncRoot(dir0), SyncRoot(dir1))
 
+        # A sibling sorting between a root and its subdirectory must not hide
+        # the overlap.
+        dir2 = dir0 + "-sibling"
+        with self.assertRaises(ValueError):
+            Synchronizer(SyncRoot(dir0), SyncRoot(dir2), SyncRoot(dir1))
+
+    def test_sibling_roots_with_common_prefix(self):
+        """Roots which only share a name prefix don't overlap."""
+        dir0 = self.make_temp_dir()
+        dir1 = dir0 + "-sibling"
+        Synchronizer(SyncRoot(dir0), SyncRoot(dir1))
+
+    def test_no_leftover_threads(self):
+        """Worker threads are shut down once a sync is done."""
+        dir0, dir1, dir2 = self.make_temp_dirs(3)
+        self.write_file(dir0, "foo", "bar")
+        thread_count = threading.active_count()
+        self.sync_all()
+        self.assertEqual(threading.active_count(), thread_count)
+
     def test_file_in_dir(self):
         dir0, dir1 = self.make_temp_dirs(2)
         self.write_file(dir0, "subdir/foo", "bar")
@@ -179,6 +313,41 @@ class TestSync(unittest.TestCase):
         self.assertFile(dir0, "subdir/foo", "bar")
         self.assertFile(dir1, "subdir/foo", "bar")
 
+    def test_file_in_unchanged_dir(self):
+        """New file below a directory whose listing hasn't changed."""
+        dir0, dir1 = self.make_temp_dirs(2)
+        self.write_dir(dir0, "a/b")
+        # A directory's ctime can't be set back, so trust any times recorded
+        # before the previous sync, however recent.
+        with mock.patch("justsync.syncroot.DIR_MTIME_GRANULARITY_NS", 0):
+            self.sync_all()
+            self.sync_all()
+
+            self.write_file(dir0, "a/b/foo", "bar")
+            self.sync_all()
+        self.assertFile(dir1, "a/b/foo", "bar")
+
+    def test_file_in_dir_with_restored_mtime(self):
+        """New file in a directory whose mtime was set back afterwards."""
+        dir0, dir1 = self.make_temp_dirs(2)
+        self.write_dir(dir0, "a")
+        with mock.patch("justsync.syncroot.DIR_MTIME_GRANULARITY_NS", 0):
+            self.sync_all()
+            self.sync_all()
+
+            # Like `tar x` or `rsync -t`, restore the directory's mtime after
+            # adding to it. Only its ctime shows the change.
+            dir0_a = os.path.join(dir0, "a")
+            old_stat = os.stat(dir0_a)
+            self.write_file(dir0, "a/foo", "bar")
+            os.utime(dir0_a, ns=(old_stat.st_atime_ns, old_stat.st_mtime_ns))
+            while os.stat(dir0_a).st_ctime_ns == old_stat.st_ctime_ns:
+                time.sleep(0.001)
+                os.utime(dir0_a,
+                         ns=(old_stat.st_atime_ns, old_stat.st_mtime_ns))
+            self.sync_all()
+        self.assertFile(dir1, "a/foo", "bar")
+
     def test_empty_dir(self):
         dir0, dir1 = self.make_temp_dirs(2)
         self.write_dir(dir0, "emptydir")
@@ -254,6 +423,60 @@ class TestSync(unittest.TestCase):
         self.assertDirPresent(dir1, "subdir")
         self.assertDirPresent(dir2, "subdir")
 
+    def test_manifest_hash(self):
+        """Synchronized roots have the same manifest hash."""
+        dir0, dir1 = self.make_temp_dirs(2)
+        self.write_file(dir0, "foo", "bar")
+        self.write_file(dir0, "dir/baz", "qux")
+        self.sync_all()
+        self.assertEqual(SyncRoot(dir0).state.manifest_hash(),
+                         SyncRoot(dir1).state.manifest_hash())
+
+        self.write_file(dir0, "foo", "changed")
+        self.sync_dirs(dir0)
+        self.assertNotEqual(SyncRoot(dir0).state.manifest_hash(),
+                            SyncRoot(dir1).state.manifest_hash())
+
+    def test_copies_not_rehashed(self):
+        """Copied files keep the hash taken while copying them."""
+        dir0, dir1, dir2 = self.make_temp_dirs(3)
+        self.write_file(dir0, "foo", "bar")
+        with mock.patch("justsync.syncroot.get_file_hash",
+                        wraps=get_file_hash) as spy:
+            self.sync_all()
+        hashed = {call.args[0] for call in spy.call_args_list}
+        self.assertNotIn(os.path.join(dir1, "foo"), hashed)
+        self.assertNotIn(os.path.join(dir2, "foo"), hashed)
+        self.assertFile(dir1, "foo", "bar")
+        self.assertFile(dir2, "foo", "bar")
+
+    @unittest.skipUnless(hasattr(os, "copy_file_range"),
+                         "needs os.copy_file_range")
+    def test_copy_in_kernel(self):
+        """Files are copied with copy_file_range when they can't be cloned."""
+        dir0, dir1 = self.make_temp_dirs(2)
+        self.write_file(dir0, "foo", "bar")
+        with mock.patch("justsync.syncroot.fcntl", None), \
+                mock.patch("os.copy_file_range",
+                           wraps=os.copy_file_range) as spy:
+            self.sync_all()
+        self.assertTrue(spy.called)
+        self.assertFile(dir1, "foo", "bar")
+        self.assertEqual(SyncRoot(dir1).state.path_get_hash("foo"),
+                         get_file_hash(os.path.join(dir1, "foo")))
+
+    def test_copy_kernel_copies_nothing(self):
+        """A kernel copy that copies nothing falls back to another method."""
+        dir0, dir1 = self.make_temp_dirs(2)
+        self.write_file(dir0, "foo", "bar")
+        with mock.patch("justsync.syncroot.fcntl", None), \
+                mock.patch("os.copy_file_range", return_value=0, create=True), \
+                mock.patch("os.sendfile", return_value=0):
+            self.sync_all()
+        self.assertFile(dir1, "foo", "bar")
+        self.assertEqual(SyncRoot(dir1).state.path_get_hash("foo"),
+                         get_file_hash(os.path.join(dir1, "foo")))
+
     def test_change_file_to_dir_with_file(self):
         """Changing a file into a directory of the same name."""
         #TODO: File must be removed before directory is created
@@ -312,6 +535,7 @@ class TestSync(unittest.TestCase):
         self.assertFile(dir0, "foo", "bar")
         self.assertFile(dir1, "foo", "bar")
 
+    @posix_only
     def test_file_executable_bit(self):
         dir0, dir1 = self.make_temp_dirs(2)
         self.write_file(dir0, "foo", "bar")
@@ -330,6 +554,8 @@ class TestSync(unittest.TestCase):
         # Executable bit is set
         stat_result = os.stat(dir0_foo)
         self.assertTrue(stat_result.st_mode & stat.S_IXUSR)
+        stat_result = os.stat(os.path.join(dir1, "foo"))
+        self.assertTrue(stat_result.st_mode & stat.S_IXUSR)
 
     def test_file_conflict(self):
         """Basic conflict where two roots edit the same file."""
@@ -338,8 +564,13 @@ class TestSync(unittest.TestCase):
         self.sync_all()
 
         self.write_file(dir0, "foo", "bar")
-        time.sleep(0.1)
+        # The later change is judged by ctime, which can't be set directly.
+        # Rewrite until the clock has moved past the first write.
+        dir0_ctime = os.stat(os.path.join(dir0, "foo")).st_ctime_ns
         self.write_file(dir1, "foo", "baz")
+        while os.stat(os.path.join(dir1, "foo")).st_ctime_ns <= dir0_ctime:
+            time.sleep(0.001)
+            self.write_file(dir1, "foo", "baz")
         self.sync_all()
         # File with later mtime wins
         self.assertFile(dir0, "foo", "baz")
@@ -377,58 +608,55 @@ class TestSync(unittest.TestCase):
         self.assertFileAbsent(dir0, "foo")
         self.assertFileAbsent(dir1, "foo")
 
+    @posix_only
     def test_symlink(self):
         dir0, dir1 = self.make_temp_dirs(2)
-        target1 = os.path.join(self.temp_dir_base, "target1")
-        target2 = os.path.join(self.temp_dir_base, "target2")
+        target1 = self.symlink_target_file
+        target2 = self.symlink_target_file2
         dir0_link = os.path.join(dir0, "foo")
-        dir1_link = os.path.join(dir1, "foo")
-        with open(target1, 'w') as f:
-            f.write("Target Contents")
-        with open(target2, 'w') as f:
-            f.write("Target Contents 2")
 
         os.symlink(target1, dir0_link)
-        self.assertTrue(stat.S_ISLNK(os.stat(dir0_link, follow_symlinks=False).st_mode))
-        self.assertEqual(os.readlink(dir0_link), target1)
+        self.assertSymlink(dir0, "foo", target1)
 
         self.sync_all()
-        self.assertTrue(stat.S_ISLNK(os.stat(dir0_link, follow_symlinks=False).st_mode))
-        self.assertTrue(stat.S_ISLNK(os.stat(dir1_link, follow_symlinks=False).st_mode))
-        self.assertEqual(os.readlink(dir0_link), target1)
-        self.assertEqual(os.readlink(dir1_link), target1)
+        self.assertSymlink(dir0, "foo", target1)
+        self.assertSymlink(dir1, "foo", target1)
 
         # Update where symlink points to
         os.remove(dir0_link)
         os.symlink(target2, dir0_link)
         self.sync_all()
-        self.assertEqual(os.readlink(dir0_link), target2)
-        self.assertEqual(os.readlink(dir1_link), target2)
+        self.assertSymlink(dir0, "foo", target2)
+        self.assertSymlink(dir1, "foo", target2)
 
+    @posix_only
+    def test_symlink_undecodable_target(self):
+        """Symlink targets which aren't valid UTF-8 are synced."""
+        dir0, dir1 = self.make_temp_dirs(2)
+        target = b"\xff-target"
+        os.symlink(target, os.path.join(dir0, "foo").encode())
+        self.sync_all()
+        self.assertEqual(os.readlink(os.path.join(dir1, "foo").encode()), target)
+
+    @posix_only
     def test_symlink_dir(self):
         dir0, dir1 = self.make_temp_dirs(2)
-        target = os.path.join(self.temp_dir_base, "target")
+        target = self.symlink_target_dir
         dir0_link = os.path.join(dir0, "foo")
-        dir1_link = os.path.join(dir1, "foo")
 
-        os.makedirs(target)
         os.symlink(target, dir0_link)
-        self.assertTrue(stat.S_ISLNK(os.stat(dir0_link, follow_symlinks=False).st_mode))
-        self.assertEqual(os.readlink(dir0_link), target)
+        self.assertSymlink(dir0, "foo", target)
 
         self.sync_all()
-        self.assertTrue(stat.S_ISLNK(os.stat(dir0_link, follow_symlinks=False).st_mode))
-        self.assertTrue(stat.S_ISLNK(os.stat(dir1_link, follow_symlinks=False).st_mode))
-        self.assertEqual(os.readlink(dir0_link), target)
-        self.assertEqual(os.readlink(dir1_link), target)
+        self.assertSymlink(dir0, "foo", target)
+        self.assertSymlink(dir1, "foo", target)
 
+    @posix_only
     def test_symlink_change_to_file(self):
         dir0, dir1 = self.make_temp_dirs(2)
-        target = os.path.join(self.temp_dir_base, "target")
+        target = self.symlink_target_file
         dir0_link = os.path.join(dir0, "foo")
         dir1_link = os.path.join(dir1, "foo")
-        with open(target, 'w') as f:
-            f.write("Target Contents")
         os.symlink(target, dir0_link)
         self.sync_all()
 
@@ -438,16 +666,14 @@ class TestSync(unittest.TestCase):
         self.sync_all()
         self.assertFile(dir0, "foo", "Now a file")
         self.assertFile(dir1, "foo", "Now a file")
-        self.assertFalse(stat.S_ISLNK(os.stat(dir0_link, follow_symlinks=False).st_mode))
-        self.assertFalse(stat.S_ISLNK(os.stat(dir1_link, follow_symlinks=False).st_mode))
+        self.assertFalse(stat.S_ISLNK(os.lstat(dir0_link).st_mode))
+        self.assertFalse(stat.S_ISLNK(os.lstat(dir1_link).st_mode))
 
+    @posix_only
     def test_file_change_to_symlink(self):
         dir0, dir1 = self.make_temp_dirs(2)
-        target = os.path.join(self.temp_dir_base, "target")
+        target = self.symlink_target_file
         dir0_link = os.path.join(dir0, "foo")
-        dir1_link = os.path.join(dir1, "foo")
-        with open(target, 'w') as f:
-            f.write("Target Contents")
         self.write_file(dir0, "foo", "bar")
         self.sync_all()
         self.assertFile(dir1, "foo", "bar")
@@ -455,18 +681,15 @@ class TestSync(unittest.TestCase):
         os.remove(dir0_link)
         os.symlink(target, dir0_link)
         self.sync_all()
-        self.assertTrue(stat.S_ISLNK(os.stat(dir0_link, follow_symlinks=False).st_mode))
-        self.assertTrue(stat.S_ISLNK(os.stat(dir1_link, follow_symlinks=False).st_mode))
-        self.assertEqual(os.readlink(dir0_link), target)
-        self.assertEqual(os.readlink(dir1_link), target)
+        self.assertSymlink(dir0, "foo", target)
+        self.assertSymlink(dir1, "foo", target)
 
+    @posix_only
     def test_delete_symlink_to_dir(self):
         dir0, dir1 = self.make_temp_dirs(2)
-        target = os.path.join(self.temp_dir_base, "target")
+        target = self.symlink_target_dir
         dir0_link = os.path.join(dir0, "foo")
-        dir1_link = os.path.join(dir1, "foo")
 
-        os.makedirs(target)
         os.symlink(target, dir0_link)
         self.sync_all()
         self.assertFilePresent(dir1, "foo")